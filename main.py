@@ -1,8 +1,26 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import google.generativeai as genai
+from google.generativeai import caching
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+import httpx
+import asyncio
 import os
 import re
+import json
+import hashlib
+import itertools
+import tarfile
+import threading
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from pathlib import Path
+import numpy as np
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -11,21 +29,166 @@ load_dotenv()
 # Streamlit configuration
 st.set_page_config(page_title="GitHub Codebase Chatbot", layout="wide")
 
+# GitHub rate limiting: api.github.com and raw.githubusercontent.com are separate buckets
+API_CONCURRENCY = 10
+RAW_CONCURRENCY = 10
+MAX_RETRY_WAIT_SECONDS = 60
+# How often async fetches re-check the process-wide raw-host semaphore for a free slot
+RAW_SLOT_POLL_SECONDS = 0.05
+RAW_HOST_URL = "https://raw.githubusercontent.com/"
+
+@st.cache_resource
+def get_rate_limiters():
+    # Built once per server process, not per rerun, so the caps apply across all sessions
+    return threading.BoundedSemaphore(API_CONCURRENCY), threading.BoundedSemaphore(RAW_CONCURRENCY)
+
+API_SEMAPHORE, RAW_SEMAPHORE = get_rate_limiters()
+
+# GraphQL loads branch and tree in one request (plus small repos' contents); deeper trees fall back to REST
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_TREE_DEPTH = 8
+# Listings with more files than this use REST; contents are only prefetched up to GRAPHQL_MAX_TEXT_BYTES
+GRAPHQL_MAX_FILES = 2000
+GRAPHQL_MAX_TEXT_BYTES = 5_000_000
+GRAPHQL_TEXT_BATCH = 100
+
+# Branch whose tree is fetched speculatively while the default branch is looked up
+SPECULATIVE_BRANCH = "main"
+
+# Binaries/assets (by extension) and files over MAX_BYTES are skipped; everything else is listed and loaded
+MAX_BYTES = 200_000
+BINARY_EXTS = {
+    "png", "jpg", "jpeg", "gif", "bmp", "ico", "webp", "tif", "tiff", "psd",
+    "pdf", "doc", "docx", "xls", "xlsx", "ppt", "pptx",
+    "zip", "gz", "tgz", "bz2", "xz", "7z", "rar", "tar", "jar", "war", "whl", "egg",
+    "exe", "dll", "so", "dylib", "o", "a", "lib", "bin", "class", "pyc", "pyo", "wasm",
+    "woff", "woff2", "ttf", "otf", "eot",
+    "mp3", "mp4", "wav", "ogg", "flac", "avi", "mov", "mkv", "webm",
+    "pt", "pth", "ckpt", "h5", "onnx", "pkl", "pickle", "npy", "npz", "parquet",
+    "db", "sqlite", "sqlite3", "dat",
+}
+
+# Local on-disk cache (file blobs by Git SHA, retrieval indexes)
+CACHE_DIR = Path.home() / ".cache" / "ghchatbot"
+
+# Retrieval over the full repository: ~1 KB chunks, top-k sent per question
+EMBEDDING_MODEL = "models/text-embedding-004"
+CHUNK_CHARS = 1000
+EMBED_BATCH_SIZE = 100
+TOP_K_CHUNKS = 8
+# Retrieval is only used above this size (~500k tokens, half of Gemini 2.0 Flash's window);
+# smaller repositories are sent whole (via a context cache) so overview questions see every file
+RETRIEVAL_MIN_CHARS = 2_000_000
+
+# Gemini context caching for full-repo analysis (needs an explicit model version)
+CACHED_MODEL_NAME = "models/gemini-2.0-flash-001"
+CODE_CACHE_TTL = datetime.timedelta(hours=1)
+# The TTL is extended once a cache is this close to expiring
+CODE_CACHE_REFRESH_MARGIN = datetime.timedelta(minutes=10)
+# Smaller codebases are sent inline: caching needs at least 4,096 tokens (~4 characters each)
+CODE_CACHE_MIN_CHARS = 4096 * 4
+
+# Minimum seconds between re-renders of a streaming chat response
+STREAM_FLUSH_INTERVAL = 0.05
+
+# Lines of a single file shown per page in the code preview
+PREVIEW_LINES = 500
+
+# Above this many files the selectbox shows a filtered shortlist of at most MAX_FILE_OPTIONS paths
+LARGE_REPO_FILE_COUNT = 2000
+MAX_FILE_OPTIONS = 200
+
+# (connect, read) timeout in seconds for the repository archive download
+ARCHIVE_TIMEOUT = (10, 60)
+
+# Connection pool size per host for the shared requests session
+HTTP_POOL_SIZE = 32
+
+# How long memoized GitHub responses are reused before revalidating with ETags
+CACHE_TTL_SECONDS = 900
+
+GITHUB_URL_RE = re.compile(r"https://github\.com/([^/]+)/([^/]+)")
+
 # --- Helper Functions ---
 def parse_github_url(url: str):
-    pattern = r"https://github\.com/([^/]+)/([^/]+)"
-    match = re.match(pattern, url)
+    match = GITHUB_URL_RE.match(url)
     if match:
-        return match.group(1), match.group(2).split('.git')[0]
+        return match.group(1), match.group(2).removesuffix('.git')
     return None, None
 
+@st.cache_resource
+def get_session():
+    # Shared across reruns so TCP/TLS connections to GitHub are reused
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries))
+    session.headers["Accept"] = "application/vnd.github+json"
+    return session
+
+def get_retry_delay(response):
+    """Seconds to wait before retrying a rate-limited response, or None if it should not be retried."""
+    if response.status_code not in (403, 429):
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), MAX_RETRY_WAIT_SECONDS)
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        reset_at = response.headers.get("X-RateLimit-Reset")
+        if reset_at and reset_at.isdigit():
+            return min(max(int(reset_at) - time.time(), 1), MAX_RETRY_WAIT_SECONDS)
+    # A plain 403 is a permission error, not throttling
+    return 1 if response.status_code == 429 else None
+
+def rate_limited_request(method: str, url: str, headers: dict = None, semaphore=API_SEMAPHORE, **kwargs):
+    session = get_session()
+    with semaphore:
+        response = session.request(method, url, headers=headers, **kwargs)
+        delay = get_retry_delay(response)
+        if delay is not None:
+            response.close() # Frees the connection when streaming
+            time.sleep(delay)
+            response = session.request(method, url, headers=headers, **kwargs)
+    # GraphQL has its own points budget; the sidebar shows the REST ("core") one
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    if remaining is not None and response.headers.get("X-RateLimit-Resource", "core") == "core":
+        st.session_state.rate_limit_remaining = remaining
+    return response
+
+def with_etag(url: str, headers: dict = None):
+    """Add If-None-Match when we already hold a body for this URL."""
+    cached = st.session_state.etag_cache.get(url)
+    if cached:
+        return {**(headers or {}), "If-None-Match": cached["etag"]}
+    return headers
+
+def resolve_etag(url: str, response):
+    """Return the response body, reusing the cached copy on 304 and remembering new ETags."""
+    if response.status_code == 304:
+        return st.session_state.etag_cache[url]["body"]
+    response.raise_for_status()
+    etag = response.headers.get("ETag")
+    # Only the small API JSON bodies are kept; raw file contents live in the blob cache
+    if etag and not url.startswith(RAW_HOST_URL):
+        st.session_state.etag_cache[url] = {"etag": etag, "body": response.text}
+    return response.text
+
+def cached_get(url: str, headers: dict = None, semaphore=API_SEMAPHORE):
+    # 304 Not Modified responses don't count against the primary rate limit
+    response = rate_limited_request("GET", url, headers=with_etag(url, headers), semaphore=semaphore)
+    return resolve_etag(url, response)
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def fetch_body(url: str, github_token: str = None):
+    # The token stays part of the cache key so one user's private repo never leaks to another.
+    # Exceptions are not cached, so failed fetches are retried on the next call.
+    headers = {"Authorization": f"token {github_token}"} if github_token else {}
+    semaphore = RAW_SEMAPHORE if url.startswith(RAW_HOST_URL) else API_SEMAPHORE
+    return cached_get(url, headers=headers, semaphore=semaphore)
+
 def get_repo_default_branch(owner: str, repo: str, github_token: str = None):
     api_url = f"https://api.github.com/repos/{owner}/{repo}"
-    headers = {"Authorization": f"token {github_token}"} if github_token else {}
     try:
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()
-        return response.json().get("default_branch", "main")
+        return json.loads(fetch_body(api_url, github_token)).get("default_branch", "main")
     except requests.exceptions.RequestException as e: # More specific exception
         st.error(f"Error fetching branch: {e}")
         return None
@@ -34,14 +197,15 @@ def get_repo_default_branch(owner: str, repo: str, github_token: str = None):
         return None
 
 
-def get_repo_files(owner: str, repo: str, branch: str, github_token: str = None):
+def fetch_repo_tree(owner: str, repo: str, branch: str, github_token: str = None):
+    # Raises on failure; get_repo_files is the reporting wrapper
     api_url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
-    headers = {"Authorization": f"token {github_token}"} if github_token else {}
+    tree = json.loads(fetch_body(api_url, github_token)).get("tree", [])
+    return [item for item in tree if item["type"] == "blob"]
+
+def get_repo_files(owner: str, repo: str, branch: str, github_token: str = None):
     try:
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()
-        tree = response.json().get("tree", [])
-        return [item for item in tree if item["type"] == "blob"]
+        return fetch_repo_tree(owner, repo, branch, github_token)
     except requests.exceptions.RequestException as e: # More specific exception
         st.error(f"Error fetching files: {e}")
         return None
@@ -49,11 +213,172 @@ def get_repo_files(owner: str, repo: str, branch: str, github_token: str = None)
         st.error(f"Unexpected error fetching files: {e}")
         return None
 
-def fetch_github_code(raw_url: str):
-    try:
-        response = requests.get(raw_url)
+def build_tree_query(depth: int):
+    # GraphQL has no recursion, so the tree selection is nested `depth` levels deep.
+    # Trees at the last level only select their oid, which marks the listing as incomplete.
+    # Blob text is not selected here; see gql_prefetch_texts.
+    entries = "entries { path type object { ... on Blob { oid byteSize isBinary } ... on Tree { oid } } }"
+    for _ in range(depth - 1):
+        entries = f"entries {{ path type object {{ ... on Blob {{ oid byteSize isBinary }} ... on Tree {{ {entries} }} }} }}"
+    return f"""query($owner: String!, $name: String!) {{
+  repository(owner: $owner, name: $name) {{
+    defaultBranchRef {{ name }}
+    object(expression: "HEAD:") {{ ... on Tree {{ {entries} }} }}
+  }}
+}}"""
+
+def walk_tree_entries(entries: list):
+    for entry in entries:
+        obj = entry.get("object") or {}
+        if entry["type"] == "tree":
+            if "entries" not in obj:
+                raise ValueError(f"Repository tree is deeper than {GRAPHQL_TREE_DEPTH} levels")
+            yield from walk_tree_entries(obj["entries"])
+        elif entry["type"] == "blob":
+            yield entry["path"], obj
+
+def gql_query(query: str, variables: dict, github_token: str):
+    # Raises on HTTP or GraphQL errors
+    response = rate_limited_request(
+        "POST", GRAPHQL_URL,
+        headers={"Authorization": f"bearer {github_token}"},
+        json={"query": query, "variables": variables},
+    )
+    response.raise_for_status()
+    payload = response.json()
+    if payload.get("errors"):
+        raise ValueError(payload["errors"][0].get("message", "GraphQL error"))
+    return payload["data"]
+
+def gql_prefetch_texts(owner: str, repo: str, blobs: list, github_token: str):
+    """Fetch the text of the given (path, blob) pairs by oid and store it in the blob cache."""
+    for start in range(0, len(blobs), GRAPHQL_TEXT_BATCH):
+        batch = blobs[start:start + GRAPHQL_TEXT_BATCH]
+        # oids are hex, so they can be inlined as aliased object lookups
+        selections = " ".join(f'b{i}: object(oid: "{blob["oid"]}") {{ ... on Blob {{ text }} }}' for i, (_, blob) in enumerate(batch))
+        data = gql_query(f"query($owner: String!, $name: String!) {{ repository(owner: $owner, name: $name) {{ {selections} }} }}", {"owner": owner, "name": repo}, github_token)
+        for i, (_, blob) in enumerate(batch):
+            text = (data["repository"].get(f"b{i}") or {}).get("text")
+            write_blob_cache(blob["oid"], text)
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def gql_fetch_repo(owner: str, repo: str, github_token: str):
+    """Fetch the default branch and file list via GraphQL, prefetching small repos' contents.
+
+    Returns (branch, files, prefetch_error) with files shaped like REST tree items and
+    prefetch_error a message when contents could not be prefetched. Only text files that
+    pass is_text_file and are missing from the blob cache have their contents fetched, and
+    only when their total size stays under GRAPHQL_MAX_TEXT_BYTES; larger repos load their
+    contents through the archive later. Returns None for listings over GRAPHQL_MAX_FILES
+    and raises on any failure, so callers can fall back to REST.
+    """
+    repository = gql_query(build_tree_query(GRAPHQL_TREE_DEPTH), {"owner": owner, "name": repo}, github_token)["repository"]
+    blobs = list(walk_tree_entries(repository["object"]["entries"]))
+    if len(blobs) > GRAPHQL_MAX_FILES:
+        return None # Returned rather than raised so the verdict is memoized too
+    files = [{"path": file_path, "type": "blob", "size": blob.get("byteSize", 0), "sha": blob.get("oid")} for file_path, blob in blobs]
+    wanted = [
+        (file_path, blob) for file_path, blob in blobs
+        if blob.get("oid") and not blob.get("isBinary") and is_text_file(file_path, blob.get("byteSize", 0))
+        and read_blob_cache(blob["oid"]) is None
+    ]
+    prefetch_error = None
+    if sum(blob.get("byteSize", 0) for _, blob in wanted) <= GRAPHQL_MAX_TEXT_BYTES:
+        try:
+            gql_prefetch_texts(owner, repo, wanted, github_token)
+        except Exception as e: # The listing is still valid; contents load on demand instead
+            prefetch_error = str(e)
+    return repository["defaultBranchRef"]["name"], files, prefetch_error
+
+def is_text_file(file_path: str, size: int = 0):
+    # Extensionless files (Dockerfile, Makefile, LICENSE, .gitignore) count as text
+    return get_file_extension(file_path).lower() not in BINARY_EXTS and size <= MAX_BYTES
+
+def fetch_repo_tarball(owner: str, repo: str, branch: str, github_token: str = None):
+    """Download the whole branch as one gzipped tarball and return {path: text} for source files.
+
+    Raises requests/tarfile errors to the caller.
+    """
+    api_url = f"https://api.github.com/repos/{owner}/{repo}/tarball/{branch}"
+    headers = {"Authorization": f"token {github_token}"} if github_token else {}
+    files = {}
+    response = rate_limited_request("GET", api_url, headers=headers, stream=True, timeout=ARCHIVE_TIMEOUT)
+    with response:
         response.raise_for_status()
-        return response.text
+        response.raw.decode_content = True
+        try:
+            with tarfile.open(fileobj=response.raw, mode="r|gz") as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    # Members are prefixed with a "<owner>-<repo>-<sha>/" directory
+                    file_path = member.name.partition("/")[2]
+                    if not is_text_file(file_path, member.size):
+                        continue
+                    files[file_path] = archive.extractfile(member).read().decode("utf-8", errors="replace")
+        except Urllib3HTTPError as e:
+            # Reading response.raw directly bypasses requests' wrapping of resets/timeouts mid-download
+            raise requests.exceptions.ConnectionError(e) from e
+    return files
+
+def format_file_block(file_path: str, code: str):
+    if code:
+        ext = get_file_extension(file_path)
+        return f"\n\n--- FILE: {file_path} ---\n```{ext}\n{code}\n```"
+    return f"\n\n--- FILE: {file_path} --- (Error fetching content)"
+
+def build_raw_url(owner: str, repo: str, branch: str, file_path: str):
+    return f"{RAW_HOST_URL}{owner}/{repo}/{branch}/{file_path.replace(' ', '%20')}"
+
+def blob_cache_path(sha: str):
+    return CACHE_DIR / "blobs" / sha[:2] / sha
+
+def read_blob_cache(sha: str = None):
+    if not sha:
+        return None
+    try:
+        # Bytes, not read_text: text mode would turn CRLF into LF and break the SHA match
+        return blob_cache_path(sha).read_bytes().decode("utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def git_blob_sha(data: bytes):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+def write_blob_cache(sha: str, text: str):
+    # Blob SHAs are content hashes, so an existing entry never needs rewriting
+    if not sha or text is None:
+        return
+    path = blob_cache_path(sha)
+    if path.exists():
+        return
+    data = text.encode("utf-8")
+    # Content is fetched by branch name but keyed by the (possibly older) tree listing's SHA:
+    # only store it if it really is that blob, otherwise the wrong text would be cached forever
+    if git_blob_sha(data) != sha:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Unique temp file per writer, so concurrent sessions never replace a half-written blob into place
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+            os.replace(tmp_name, path)
+        except OSError:
+            os.remove(tmp_name)
+            raise
+    except OSError:
+        pass # The cache is an optimization only
+
+def fetch_github_code(raw_url: str, sha: str = None):
+    cached = read_blob_cache(sha)
+    if cached is not None:
+        return cached
+    try:
+        code = fetch_body(raw_url)
+        write_blob_cache(sha, code)
+        return code
     except requests.exceptions.RequestException as e: # More specific exception
         st.error(f"Error fetching file content: {e}")
         return None
@@ -62,11 +387,145 @@ def fetch_github_code(raw_url: str):
         return None
 
 
-def get_file_extension(filename_or_url: str):
+async def acquire_raw_slot():
+    # Polls the shared threading semaphore so the event loop never blocks on it
+    while not RAW_SEMAPHORE.acquire(blocking=False):
+        await asyncio.sleep(RAW_SLOT_POLL_SECONDS)
+
+async def afetch(client: httpx.AsyncClient, url: str, semaphore: asyncio.Semaphore):
+    # The local semaphore bounds how many tasks of this load wait for a slot;
+    # RAW_SEMAPHORE caps raw-host requests across all sessions
+    async with semaphore:
+        await acquire_raw_slot()
+        try:
+            response = await client.get(url)
+            delay = get_retry_delay(response)
+            if delay is not None:
+                await asyncio.sleep(delay)
+                response = await client.get(url)
+        finally:
+            RAW_SEMAPHORE.release()
+    response.raise_for_status()
+    return response.text
+
+async def load_full(raw_urls: list, on_done=None):
+    """Fetch all raw URLs concurrently over one HTTP/2 client.
+
+    Results keep the order of `raw_urls`; failed fetches are returned as the exception.
+    `on_done` is called after each fetch completes (runs on the event loop thread).
+    """
+    # No more connections than requests that can be in flight
+    limits = httpx.Limits(max_connections=RAW_CONCURRENCY)
+    # Created here so it is bound to the event loop started by asyncio.run
+    semaphore = asyncio.Semaphore(RAW_CONCURRENCY)
+    async with httpx.AsyncClient(http2=True, limits=limits, follow_redirects=True) as client:
+        async def fetch_one(url):
+            try:
+                return await afetch(client, url, semaphore)
+            finally:
+                if on_done:
+                    on_done()
+        return await asyncio.gather(*(fetch_one(url) for url in raw_urls), return_exceptions=True)
+
+
+def chunk_file(file_path: str, code: str):
+    """Split a file into ~CHUNK_CHARS pieces on line boundaries, each tagged with its path."""
+    chunks, current, size = [], [], 0
+    for line in code.splitlines(keepends=True):
+        # Hard-split long lines (e.g. minified code) so no chunk exceeds CHUNK_CHARS
+        for start in range(0, len(line), CHUNK_CHARS):
+            piece = line[start:start + CHUNK_CHARS]
+            if current and size + len(piece) > CHUNK_CHARS:
+                chunks.append(current)
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece)
+    if current:
+        chunks.append(current)
+    return [f"--- FILE: {file_path} ---\n{''.join(lines)}" for lines in chunks]
+
+def embed_texts(texts: list, task_type: str):
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=texts[start:start + EMBED_BATCH_SIZE], task_type=task_type)
+        vectors.extend(result["embedding"])
+    matrix = np.asarray(vectors, dtype=np.float32)
+    # Unit rows, so a dot product is the cosine similarity
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+def build_repo_index(owner: str, repo: str, repo_texts: dict, code_key: str):
+    """Return (chunks, embeddings) for the repository, reusing the copy saved on disk for the same code."""
+    index_path = CACHE_DIR / "index" / f"{owner}_{repo}_{code_key}.npz"
+    # Chunk texts go in a JSON sidecar: a NumPy string array pads every row to the longest chunk
+    chunks_path = index_path.with_suffix(".json")
+    if index_path.exists() and chunks_path.exists():
+        with np.load(index_path) as data:
+            return json.loads(chunks_path.read_text(encoding="utf-8")), data["embeddings"]
+    chunks = [chunk for file_path, code in repo_texts.items() if code for chunk in chunk_file(file_path, code)]
+    if not chunks:
+        return None
+    embeddings = embed_texts(chunks, "retrieval_document")
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(index_path, embeddings=embeddings)
+    chunks_path.write_text(json.dumps(chunks), encoding="utf-8")
+    return chunks, embeddings
+
+def retrieve_chunks(query: str, chunks: list, embeddings, k: int = TOP_K_CHUNKS):
+    scores = embeddings @ embed_texts([query], "retrieval_query")[0]
+    k = min(k, len(chunks))
+    top = np.argpartition(scores, -k)[-k:]
+    return [chunks[i] for i in top[np.argsort(scores[top])[::-1]]]
+
+
+def build_system_instruction(context_header: str, code_to_analyze: str):
+    return f"""You are an expert AI programming assistant.
+{context_header}
+
+The user is asking questions about the following code:
+{code_to_analyze}
+
+Please answer the user's questions based *only* on the provided code context.
+Be concise and helpful. If the user asks for code, provide it in markdown format.
+If the question is outside the scope of the provided code, politely state that you cannot answer.
+If the provided code is very long (especially for full repository analysis), acknowledge that you might not be able to process every single detail but will do your best based on the overall structure and searchable content.
+"""
+
+def create_code_cache(code: str, system_instruction: str):
+    """Upload the code once and create a Gemini context cache that later turns reference."""
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8") as tmp:
+        tmp.write(code)
+    try:
+        uploaded_file = genai.upload_file(tmp.name, mime_type="text/plain")
+    finally:
+        os.remove(tmp.name)
     try:
-        return os.path.splitext(filename_or_url.split('?')[0])[-1].lstrip('.')
-    except:
-        return "plaintext"
+        return caching.CachedContent.create(
+            model=CACHED_MODEL_NAME,
+            system_instruction=system_instruction,
+            contents=[uploaded_file],
+            ttl=CODE_CACHE_TTL,
+        )
+    finally:
+        # The cache holds its own copy; otherwise the upload lingers on the File API for 48 h
+        try:
+            genai.delete_file(uploaded_file.name)
+        except Exception:
+            pass
+
+def delete_code_cache():
+    if st.session_state.gemini_cache is not None:
+        try:
+            st.session_state.gemini_cache.delete()
+        except Exception:
+            pass # It expires on its own after CODE_CACHE_TTL
+        st.session_state.gemini_cache = None
+
+
+def get_file_extension(filename_or_url: str):
+    file_name = filename_or_url.partition('?')[0].rpartition('/')[2]
+    stem, _, ext = file_name.rpartition('.')
+    # No dot, or a dotfile like ".gitignore", means no extension
+    return ext if stem and ext else "plaintext"
 
 # --- Session State Initialization ---
 # Initialize keys if they don't exist
@@ -74,11 +533,23 @@ default_values = {
     "repo_owner": None,
     "repo_name": None,
     "repo_files": [],
+    "file_path_options": (),
+    "file_path_index": {},
+    "file_shortlist": None, # (filter, matching paths) for large repositories
     "selected_file_path": None,
     "default_branch": None,
     "code_content": None,
     "current_file_url_display": None,
     "repo_code_full": None,
+    "rate_limit_remaining": None,
+    "etag_cache": {},
+    "gemini_model": None,
+    "gemini_model_context": None,
+    "gemini_cache": None,
+    "gemini_cache_expires_at": None,
+    "repo_chunks": None,
+    "repo_embeddings": None,
+    "code_preview_lines": PREVIEW_LINES,
     "messages": []
 }
 for key, default_value in default_values.items():
@@ -110,22 +581,56 @@ with st.sidebar:
             if owner and repo:
                 st.session_state.repo_owner = owner
                 st.session_state.repo_name = repo
-                with st.spinner(f"Fetching default branch for {owner}/{repo}..."):
-                    branch = get_repo_default_branch(owner, repo, github_pat if github_pat else None)
-                
+                branch, files = None, None
+                if github_pat:
+                    # GraphQL returns the branch and file list together, plus the contents of small repos
+                    with st.spinner(f"Fetching {owner}/{repo}..."):
+                        try:
+                            branch, files, prefetch_error = gql_fetch_repo(owner, repo, github_pat) or (None, None, None)
+                            if prefetch_error:
+                                st.warning(f"Could not prefetch file contents ({prefetch_error}). They will be downloaded when needed.")
+                        except Exception: # Too deep/large for GraphQL, or GraphQL unavailable: use REST below
+                            branch, files = None, None
+
+                if files is None:
+                    with st.spinner(f"Fetching default branch for {owner}/{repo}..."):
+                        # List the likely branch while the real default branch is looked up, saving a round-trip
+                        script_ctx = get_script_run_ctx()
+                        with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, script_ctx)) as executor:
+                            branch_future = executor.submit(get_repo_default_branch, owner, repo, github_pat if github_pat else None)
+                            tree_future = executor.submit(fetch_repo_tree, owner, repo, SPECULATIVE_BRANCH, github_pat if github_pat else None)
+                            branch = branch_future.result()
+                            try:
+                                speculative_files = tree_future.result()
+                            except Exception: # Wrong guess (e.g. no such branch): fetched again below
+                                speculative_files = None
+
+                    if branch:
+                        if branch == SPECULATIVE_BRANCH and speculative_files is not None:
+                            files = speculative_files
+                        else:
+                            with st.spinner(f"Fetching files from branch '{branch}'..."):
+                                files = get_repo_files(owner, repo, branch, github_pat if github_pat else None)
+
                 if branch:
                     st.session_state.default_branch = branch
-                    with st.spinner(f"Fetching files from branch '{branch}'..."):
-                        files = get_repo_files(owner, repo, branch, github_pat if github_pat else None)
                     
                     if files is not None: # Check if files is not None (means no error in fetching)
-                        st.session_state.repo_files = files
+                        # Drop binaries and oversized blobs using the tree's size field, before any download
+                        text_files = [f for f in files if is_text_file(f["path"], f.get("size", 0))]
+                        skipped_count = len(files) - len(text_files)
+                        st.session_state.repo_files = text_files
+                        # A tuple is cheaper for the selectbox to hash than rebuilding a list every rerun
+                        st.session_state.file_path_options = ("-- Select a single file --", *(f["path"] for f in text_files))
+                        # Option position by path, so reruns don't scan the options to find the selection
+                        st.session_state.file_path_index = {path: i for i, path in enumerate(st.session_state.file_path_options)}
+                        st.session_state.file_shortlist = None
                         # Reset dependent states
                         st.session_state.selected_file_path = None
                         st.session_state.code_content = None
                         st.session_state.repo_code_full = None
                         st.session_state.messages = []
-                        st.success(f"{len(files)} files found in repository (branch: '{branch}')")
+                        st.success(f"{len(text_files)} files found in repository (branch: '{branch}', {skipped_count} binary/oversized files skipped)")
                     else:
                         st.error("Could not retrieve files. Check repository permissions or URL.")
                 else:
@@ -133,6 +638,9 @@ with st.sidebar:
             else:
                 st.error("Invalid GitHub repository URL format.")
 
+    if st.session_state.rate_limit_remaining is not None:
+        st.caption(f"GitHub API requests remaining: {st.session_state.rate_limit_remaining}")
+
     if st.session_state.repo_files:
         st.markdown("---")
         st.subheader("Analyze Code")
@@ -141,27 +649,75 @@ with st.sidebar:
             if not st.session_state.repo_files:
                 st.warning("No files loaded from repository yet.")
             else:
-                full_code_parts = []
+                repo_files = st.session_state.repo_files
+                fetch_errors = []
                 progress_bar = st.progress(0)
                 status_text = st.empty()
-                num_files = len(st.session_state.repo_files)
-
-                with st.spinner("Fetching all file contents... This might take a while for large repositories."):
-                    for i, f_item in enumerate(st.session_state.repo_files):
-                        file_path = f_item["path"]
-                        status_text.text(f"Fetching: {file_path} ({i+1}/{num_files})")
-                        # Construct raw URL carefully
-                        raw_url = f"https://raw.githubusercontent.com/{st.session_state.repo_owner}/{st.session_state.repo_name}/{st.session_state.default_branch}/{file_path.replace(' ', '%20')}"
-                        code = fetch_github_code(raw_url)
-                        if code:
-                            ext = get_file_extension(file_path)
-                            # Append structured file content
-                            full_code_parts.append(f"\n\n--- FILE: {file_path} ---\n```{ext}\n{code}\n```")
-                        else:
-                            full_code_parts.append(f"\n\n--- FILE: {file_path} --- (Error fetching content)")
-                        progress_bar.progress((i + 1) / num_files)
-                
+
+                # Blob SHAs from the tree are content-addressed: cached blobs never go stale
+                repo_texts = {f_item["path"]: read_blob_cache(f_item.get("sha")) for f_item in repo_files}
+                if any(code is None for code in repo_texts.values()):
+                    # One archive request instead of one request per file
+                    with st.spinner("Downloading repository archive..."):
+                        try:
+                            archive_texts = fetch_repo_tarball(st.session_state.repo_owner, st.session_state.repo_name, st.session_state.default_branch, github_pat if github_pat else None)
+                        except (requests.exceptions.RequestException, tarfile.TarError) as e:
+                            st.warning(f"Archive download failed ({e}). Fetching files individually instead.")
+                            archive_texts = None
+
+                    if archive_texts is not None:
+                        # Populate the blob cache so later loads and single-file selections are disk reads
+                        for f_item in repo_files:
+                            if repo_texts[f_item["path"]] is None:
+                                if f_item["path"] not in archive_texts:
+                                    # e.g. renamed since the (memoized) listing was fetched
+                                    fetch_errors.append(f"{f_item['path']}: not found in the repository archive")
+                                    continue
+                                repo_texts[f_item["path"]] = archive_texts[f_item["path"]]
+                                write_blob_cache(f_item.get("sha"), repo_texts[f_item["path"]])
+                    else:
+                        missing_files = [f_item for f_item in repo_files if repo_texts[f_item["path"]] is None]
+                        num_missing = len(missing_files)
+                        fetch_progress = {"done": 0}
+
+                        def update_progress():
+                            fetch_progress["done"] += 1
+                            status_text.text(f"Fetched {fetch_progress['done']}/{num_missing} files")
+                            progress_bar.progress(fetch_progress["done"] / num_missing)
+
+                        raw_urls = [
+                            build_raw_url(st.session_state.repo_owner, st.session_state.repo_name, st.session_state.default_branch, f_item["path"])
+                            for f_item in missing_files
+                        ]
+                        with st.spinner("Fetching all file contents... This might take a while for large repositories."):
+                            results = asyncio.run(load_full(raw_urls, on_done=update_progress))
+
+                        for f_item, code in zip(missing_files, results):
+                            if isinstance(code, Exception):
+                                fetch_errors.append(f"{f_item['path']}: {code}")
+                                code = None
+                            else:
+                                write_blob_cache(f_item.get("sha"), code)
+                            repo_texts[f_item["path"]] = code
+
+                if fetch_errors:
+                    st.error(f"Error fetching {len(fetch_errors)} file(s):\n\n" + "\n\n".join(fetch_errors))
+                full_code_parts = [format_file_block(file_path, code) for file_path, code in repo_texts.items()]
                 st.session_state.repo_code_full = "".join(full_code_parts)
+
+                # Retrieval index for repositories too large to send whole with each question
+                st.session_state.repo_chunks = None
+                st.session_state.repo_embeddings = None
+                if gemini_api_key and len(st.session_state.repo_code_full) > RETRIEVAL_MIN_CHARS:
+                    status_text.text("Indexing repository for retrieval...")
+                    try:
+                        genai.configure(api_key=gemini_api_key)
+                        code_key = hashlib.sha1(st.session_state.repo_code_full.encode("utf-8")).hexdigest()[:16]
+                        index = build_repo_index(st.session_state.repo_owner, st.session_state.repo_name, repo_texts, code_key)
+                        if index:
+                            st.session_state.repo_chunks, st.session_state.repo_embeddings = index
+                    except Exception as e:
+                        st.warning(f"Could not build the retrieval index ({e}). The full codebase will be sent with each question.")
                 st.session_state.code_content = None # Unset single file content
                 st.session_state.selected_file_path = None # Unset single file selection
                 st.session_state.messages = []
@@ -170,11 +726,25 @@ with st.sidebar:
 
 
         # Single file selection
-        file_paths = ["-- Select a single file --"] + [f["path"] for f in st.session_state.repo_files]
+        file_paths = st.session_state.file_path_options # Built once per repository load
+        path_index = st.session_state.file_path_index
+        if len(file_paths) > LARGE_REPO_FILE_COUNT:
+            # Ship a short, prefix-filtered list to the browser instead of every path
+            path_filter = st.text_input("Filter files by path:", key="file_filter_input")
+            # Recomputed only when the filter changes; stops scanning after MAX_FILE_OPTIONS matches
+            if st.session_state.file_shortlist is None or st.session_state.file_shortlist[0] != path_filter:
+                matches = (path for path in itertools.islice(file_paths, 1, None) if path.startswith(path_filter))
+                st.session_state.file_shortlist = (path_filter, tuple(itertools.islice(matches, MAX_FILE_OPTIONS)))
+            shortlist = list(st.session_state.file_shortlist[1])
+            if st.session_state.selected_file_path and st.session_state.selected_file_path not in shortlist:
+                shortlist.insert(0, st.session_state.selected_file_path) # Keep the current selection selectable
+            file_paths = (file_paths[0], *shortlist)
+            path_index = {path: i for i, path in enumerate(file_paths)} # At most MAX_FILE_OPTIONS + 2 entries
         selected_file = st.selectbox(
             "Or, select a single file to analyze:",
             options=file_paths,
-            index=0, # Default to placeholder
+            # Default to placeholder; keep the loaded file selected when the options change
+            index=path_index.get(st.session_state.selected_file_path, 0),
             key="select_single_file_sb"
         )
 
@@ -184,13 +754,16 @@ with st.sidebar:
                 st.session_state.selected_file_path = selected_file
                 st.session_state.repo_code_full = None # Unset full repo content
                 st.session_state.code_content = None # Clear previous single file content before loading new one
+                st.session_state.code_preview_lines = PREVIEW_LINES
                 st.session_state.messages = []
 
-                raw_url = f"https://raw.githubusercontent.com/{st.session_state.repo_owner}/{st.session_state.repo_name}/{st.session_state.default_branch}/{selected_file.replace(' ', '%20')}"
+                raw_url = build_raw_url(st.session_state.repo_owner, st.session_state.repo_name, st.session_state.default_branch, selected_file)
                 st.session_state.current_file_url_display = f"https://github.com/{st.session_state.repo_owner}/{st.session_state.repo_name}/blob/{st.session_state.default_branch}/{selected_file.replace(' ', '%20')}"
                 
+                # Options are "-- Select a single file --" followed by repo_files in order
+                selected_sha = st.session_state.repo_files[st.session_state.file_path_index[selected_file] - 1].get("sha")
                 with st.spinner(f"Fetching content for {selected_file}..."):
-                    code = fetch_github_code(raw_url)
+                    code = fetch_github_code(raw_url, selected_sha)
                 if code:
                     st.session_state.code_content = code
                     st.success(f"Loaded: {selected_file}")
@@ -204,6 +777,7 @@ with st.sidebar:
 
     st.markdown("---")
     if st.button("Clear All Loaded Data & Chat", key="clear_all_button"):
+        delete_code_cache()
         for key_to_clear in default_values.keys(): # Iterate through the keys we defined for session state
             st.session_state[key_to_clear] = default_values[key_to_clear]
         st.rerun()
@@ -230,9 +804,17 @@ else:
 if chat_ready:
     # Display code preview if a single file is loaded
     if st.session_state.code_content and st.session_state.selected_file_path:
-        with st.expander(f"📄 View Code: {st.session_state.selected_file_path}", expanded=False):
+        # Only highlight the file when asked to, and a page at a time: st.code is costly on every rerun
+        if st.toggle(f"📄 View Code: {st.session_state.selected_file_path}", key="show_code_toggle"):
             ext = get_file_extension(st.session_state.selected_file_path)
-            st.code(st.session_state.code_content, language=ext, line_numbers=True)
+            show_line_numbers = st.checkbox("Show line numbers", key="code_line_numbers_cb")
+            code_lines = st.session_state.code_content.splitlines()
+            visible_lines = st.session_state.code_preview_lines
+            st.code("\n".join(code_lines[:visible_lines]), language=ext, line_numbers=show_line_numbers)
+            if len(code_lines) > visible_lines:
+                if st.button(f"Load more ({len(code_lines) - visible_lines} lines remaining)", key="load_more_code_button"):
+                    st.session_state.code_preview_lines += PREVIEW_LINES
+                    st.rerun()
         st.info(f"💬 Analyzing: Single file - `{st.session_state.selected_file_path}`")
     elif st.session_state.repo_code_full:
         st.info(f"💬 Analyzing: Full repository - `{st.session_state.repo_owner}/{st.session_state.repo_name}` (overview)")
@@ -255,43 +837,82 @@ if chat_ready:
 
                 # Determine the context and code to provide for the system instruction
                 if st.session_state.repo_code_full:
-                    context_header = f"You are analyzing the full codebase from the GitHub repository: https://github.com/{st.session_state.repo_owner}/{st.session_state.repo_name}."
-                    code_to_analyze = st.session_state.repo_code_full
+                    context_source = st.session_state.repo_code_full
                 elif st.session_state.code_content and st.session_state.selected_file_path:
-                    context_header = f"You are analyzing the following file: {st.session_state.current_file_url_display} from the GitHub repository https://github.com/{st.session_state.repo_owner}/{st.session_state.repo_name}."
-                    file_ext = get_file_extension(st.session_state.selected_file_path)
-                    code_to_analyze = f"```{file_ext}\n{st.session_state.code_content}\n```"
+                    context_source = st.session_state.code_content
                 else: # Should not happen if chat_ready is true, but as a fallback
                     st.error("No code context available for analysis.")
                     st.stop()
 
-                system_instruction = f"""You are an expert AI programming assistant.
-{context_header}
-
-The user is asking questions about the following code:
-{code_to_analyze}
-
-Please answer the user's questions based *only* on the provided code context.
-Be concise and helpful. If the user asks for code, provide it in markdown format.
-If the question is outside the scope of the provided code, politely state that you cannot answer.
-If the provided code is very long (especially for full repository analysis), acknowledge that you might not be able to process every single detail but will do your best based on the overall structure and searchable content.
-"""
-                # For Gemini 2.0 Flash, which has a large context window, sending the full repo might work
-                # For other models, this might be too much. Consider truncation or summarization for repo_code_full if using models with smaller context windows.
-                
-                model = genai.GenerativeModel(
-                    model_name="gemini-2.0-flash", # Use a model that supports large context if sending full repo
-                    system_instruction=system_instruction
-                )
-                
-                stream = model.generate_content(prompt, stream=True)
+                use_retrieval = bool(st.session_state.repo_code_full) and st.session_state.repo_embeddings is not None
+
+                # Keep the context cache alive while it is in use; if that fails, rebuild the model below
+                cache_expires_at = st.session_state.gemini_cache_expires_at
+                if st.session_state.gemini_cache is not None and datetime.datetime.now() >= cache_expires_at - CODE_CACHE_REFRESH_MARGIN:
+                    try:
+                        st.session_state.gemini_cache.update(ttl=CODE_CACHE_TTL)
+                        st.session_state.gemini_cache_expires_at = datetime.datetime.now() + CODE_CACHE_TTL
+                    except Exception:
+                        st.session_state.gemini_model_context = None
+
+                # Reuse the model (and its multi-MB system instruction) until the loaded code changes.
+                # Identity check on the session string: any reload stores a new object.
+                if st.session_state.gemini_model_context is not context_source:
+                    delete_code_cache()
+                    st.session_state.gemini_model = None
+                    if st.session_state.repo_code_full:
+                        context_header = f"You are analyzing the full codebase from the GitHub repository: https://github.com/{st.session_state.repo_owner}/{st.session_state.repo_name}."
+                        if use_retrieval:
+                            code_to_analyze = "(The code excerpts most relevant to each question are included with the question.)"
+                        else:
+                            code_to_analyze = st.session_state.repo_code_full
+                            # Upload the codebase once and reference it from every turn
+                            if len(st.session_state.repo_code_full) >= CODE_CACHE_MIN_CHARS:
+                                try:
+                                    cache = create_code_cache(
+                                        st.session_state.repo_code_full,
+                                        build_system_instruction(context_header, "(The full codebase is provided in the attached file.)")
+                                    )
+                                    st.session_state.gemini_cache = cache
+                                    st.session_state.gemini_cache_expires_at = datetime.datetime.now() + CODE_CACHE_TTL
+                                    st.session_state.gemini_model = genai.GenerativeModel.from_cached_content(cached_content=cache)
+                                except Exception:
+                                    pass # Send it inline instead
+                    else:
+                        context_header = f"You are analyzing the following file: {st.session_state.current_file_url_display} from the GitHub repository https://github.com/{st.session_state.repo_owner}/{st.session_state.repo_name}."
+                        file_ext = get_file_extension(st.session_state.selected_file_path)
+                        code_to_analyze = f"```{file_ext}\n{st.session_state.code_content}\n```"
+
+                    if st.session_state.gemini_model is None:
+                        # For Gemini 2.0 Flash, which has a large context window, sending the full repo might work
+                        # For other models, this might be too much. Consider truncation or summarization for repo_code_full if using models with smaller context windows.
+                        st.session_state.gemini_model = genai.GenerativeModel(
+                            model_name="gemini-2.0-flash", # Use a model that supports large context if sending full repo
+                            system_instruction=build_system_instruction(context_header, code_to_analyze)
+                        )
+                    st.session_state.gemini_model_context = context_source
+                model = st.session_state.gemini_model
+
+                model_input = prompt
+                if use_retrieval:
+                    excerpts = retrieve_chunks(prompt, st.session_state.repo_chunks, st.session_state.repo_embeddings)
+                    model_input = "Relevant code excerpts from the repository:\n\n" + "\n\n".join(excerpts) + f"\n\nQuestion: {prompt}"
+
+                stream = model.generate_content(model_input, stream=True)
+                response_parts = []
+                last_flush = time.monotonic()
                 for chunk in stream:
                     if chunk.parts:
-                        full_response_text += chunk.text
-                        placeholder.markdown(full_response_text + "▌") # Typing effect
+                        response_parts.append(chunk.text)
+                        # Re-render at most every STREAM_FLUSH_INTERVAL instead of per chunk
+                        if time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL:
+                            placeholder.markdown("".join(response_parts) + "▌") # Typing effect
+                            last_flush = time.monotonic()
+                full_response_text = "".join(response_parts)
                 placeholder.markdown(full_response_text) # Final response
 
             except Exception as e:
+                st.session_state.gemini_model_context = None # Rebuild the model (and cache) on the next question
                 st.error(f"An error occurred with the Gemini API: {e}")
                 full_response_text = f"Sorry, I encountered an error during generation: {e}"
                 placeholder.markdown(full_response_text)